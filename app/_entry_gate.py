@@ -0,0 +1,23 @@
+"""_entry_gate.py — Decisión de entrada por candidato (sin I/O ni logging).
+
+Entry gate V5: YES en [ENTRY_YES_MIN, ENTRY_YES_MAX] AND
+(uptrend YES OR ≥ TREND_MIN_OBSERVATIONS observaciones).
+"""
+
+from app.config import ENTRY_YES_MIN, ENTRY_YES_MAX, TREND_MIN_OBSERVATIONS
+
+SKIP    = 0  # fuera del rango de entrada
+UPTREND = 1  # en rango + uptrend YES
+STABLE  = 2  # en rango + suficientes observaciones
+PENDING = 3  # en rango, esperando trend u observaciones
+
+
+def decide(rt_yes, obs, has_trend,
+           lo=ENTRY_YES_MIN, hi=ENTRY_YES_MAX, min_obs=TREND_MIN_OBSERVATIONS):
+    if not (lo <= rt_yes <= hi):
+        return SKIP
+    if has_trend:
+        return UPTREND
+    if obs >= min_obs:
+        return STABLE
+    return PENDING
@@ -13,10 +13,13 @@ Cycle:
 
 import threading
 import logging
-from datetime import datetime, timezone
+import time
+from operator import itemgetter
 
+from app import _entry_gate as entry_gate
+from app.circuit import CLOB_CB
 from app.scanner import (
-    scan_opportunities, fetch_live_prices, fetch_yes_price_clob,
+    scan_opportunities, fetch_live_prices_batch, fetch_yes_prices_clob_batch, now_utc,
 )
 from app.config import (
     MONITOR_INTERVAL, POSITION_SIZE_MIN, POSITION_SIZE_MAX,
@@ -28,6 +31,22 @@ log = logging.getLogger(__name__)
 
 MAX_CLOB_VERIFY = 20
 
+# Toda posición nace de un opp del scanner, que siempre trae ambas claves
+_TOKEN_AND_SLUG = itemgetter("yes_token_id", "slug")
+
+# Campos de last_opportunities (el scanner inicializa todos en cada opp)
+_OPP_FIELDS = (
+    "question", "yes_price", "no_price", "volume",
+    "profit_cents", "trend_obs", "has_trend",
+)
+_OPP_VIEW = itemgetter(*_OPP_FIELDS)
+
+# Constantes del sizing, precalculadas al importar (calc_position_size es hot path)
+_INV_PRICE_RANGE = (
+    1.0 / (ENTRY_YES_MAX - ENTRY_YES_MIN) if ENTRY_YES_MAX > ENTRY_YES_MIN else 0.0
+)
+_SIZE_SPAN = POSITION_SIZE_MAX - POSITION_SIZE_MIN
+
 
 def calc_position_size(capital_disponible, yes_price):
     """5%–10% de capital_disponible, proporcional al YES price.
@@ -36,14 +55,16 @@ def calc_position_size(capital_disponible, yes_price):
     YES=0.27 → 10% (mayor convicción — el mercado ya está en 27¢)
     Espejo directo de V2: más precio = más apuesta.
     """
-    price_range = ENTRY_YES_MAX - ENTRY_YES_MIN
-    if price_range <= 0:
-        pct = POSITION_SIZE_MIN
-    else:
-        t   = (yes_price - ENTRY_YES_MIN) / price_range
-        t   = max(0.0, min(1.0, t))
-        pct = POSITION_SIZE_MIN + t * (POSITION_SIZE_MAX - POSITION_SIZE_MIN)
-    return min(capital_disponible * pct, capital_disponible)
+    t = max(0.0, min(1.0, (yes_price - ENTRY_YES_MIN) * _INV_PRICE_RANGE))
+    return min(capital_disponible * (POSITION_SIZE_MIN + t * _SIZE_SPAN), capital_disponible)
+
+
+def _next_tick(prev_tick, interval):
+    """Siguiente deadline fixed-rate. Si ya se perdió (iteración más larga que
+    el intervalo), re-ancla en ahora en vez de encadenar ciclos atrasados."""
+    nxt = prev_tick + interval
+    now = time.monotonic()
+    return nxt if nxt > now else now
 
 
 class BotRunner:
@@ -54,7 +75,8 @@ class BotRunner:
         self._thread       = None
         self._price_thread = None
         self.scan_count    = 0
-        self.last_opportunities = []
+        self.last_opportunities = ()
+        self._last_opps_key     = ()
         self.status        = "stopped"
         self.last_price_update = None
 
@@ -82,12 +104,16 @@ class BotRunner:
 
     def _run(self):
         log.info("Bot V5 iniciado — Momentum YES (espejo de V2)")
+        # Fixed-rate: el próximo ciclo arranca MONITOR_INTERVAL después del
+        # inicio del anterior, no después de que termine (sin drift).
+        next_tick = time.monotonic()
         while not self._stop_event.is_set():
             try:
                 self._cycle()
             except Exception:
                 log.exception("Error en ciclo V5")
-            self._stop_event.wait(MONITOR_INTERVAL)
+            next_tick = _next_tick(next_tick, MONITOR_INTERVAL)
+            self._stop_event.wait(max(0.0, next_tick - time.monotonic()))
         log.info("Bot V5 detenido")
 
     def _cycle(self):
@@ -103,161 +129,211 @@ class BotRunner:
 
         # 1. IDs a saltar
         with portfolio.lock:
-            existing_ids = set(portfolio.positions.keys())
-            closed_ids   = {
-                p["condition_id"] for p in portfolio.closed_positions
-                if p.get("condition_id")
-            }
-            existing_ids |= closed_ids
+            existing_ids = set(portfolio.positions)
+            existing_ids |= portfolio.closed_ids
 
         # 2. Gamma discovery (YES 0.10–0.40, wide for trend building)
-        candidates = scan_opportunities(existing_ids)
+        candidates = scan_opportunities(existing_ids, stop_event=self._stop_event)
+        if candidates is None:
+            return
 
         # 3. CLOB price → record en trend_tracker → entry gate
         clob_verified = []
         display_opps  = []
-        clob_fails    = 0
-        clob_ok       = True
 
-        for opp in candidates[:MAX_CLOB_VERIFY]:
-            if self._stop_event.is_set():
-                return
-            yes_tid = opp.get("yes_token_id")
-            rt_yes, rt_no = None, None
-
-            if clob_ok and yes_tid:
-                rt_yes, rt_no = fetch_yes_price_clob(yes_tid)
-                # Sanity: si YES > 0.50 probablemente devolvió el token NO
-                if rt_yes is not None and rt_yes > 0.50:
-                    rt_yes, rt_no = None, None
-                if rt_yes is None:
-                    clob_fails += 1
-                    if clob_fails >= 2:
-                        clob_ok = False
+        to_verify = candidates[:MAX_CLOB_VERIFY]
+        clob_prices = self._fetch_prices_parallel(
+            [(o["condition_id"], o.get("yes_token_id"), o.get("slug")) for o in to_verify],
+            fallback=False,
+        )
+        if clob_prices is None:
+            return
 
+        # candidates es nuevo en cada ciclo: se enriquece cada dict in situ
+        priced = []
+        for opp in to_verify:
+            rt_yes, rt_no, _ = clob_prices.get(opp["condition_id"], (None, None, None))
             if rt_yes is None:
-                display_opps.append({
-                    **opp,
-                    "trend_obs": tracker.observation_count(opp["condition_id"]),
-                    "has_trend": False,
-                })
-                continue
-
-            # Record YES price para trend building (aunque esté fuera del rango de entrada)
-            tracker.record(opp["condition_id"], rt_yes)
-
-            opp = {**opp, "yes_price": rt_yes, "no_price": rt_no or round(1 - rt_yes, 4)}
-            obs_count = tracker.observation_count(opp["condition_id"])
-            has_trend = tracker.has_uptrend(opp["condition_id"])
-
-            display_opps.append({**opp, "trend_obs": obs_count, "has_trend": has_trend})
+                opp["trend_obs"] = tracker.observation_count(opp["condition_id"])
+                opp["has_trend"] = False
+            else:
+                opp["yes_price"] = rt_yes
+                opp["no_price"]  = rt_no or round(1 - rt_yes, 4)
+                priced.append(opp)
+            display_opps.append(opp)
+
+        # Record YES price para trend building (aunque esté fuera del rango de
+        # entrada) — todo el lote bajo un solo lock del tracker
+        trend_stats = tracker.record_many(
+            [(o["condition_id"], o["yes_price"]) for o in priced]
+        )
+
+        for opp in priced:
+            rt_yes = opp["yes_price"]
+            obs_count, has_trend = trend_stats[opp["condition_id"]]
+            opp["trend_obs"] = obs_count
+            opp["has_trend"] = has_trend
 
             # Entry gate: YES en rango + (uptrend YES O ≥4 obs en rango)
-            stable_in_range = (obs_count >= TREND_MIN_OBSERVATIONS)
-            if ENTRY_YES_MIN <= rt_yes <= ENTRY_YES_MAX and (has_trend or stable_in_range):
-                entry_type = "uptrend" if has_trend else "stable"
+            gate = entry_gate.decide(rt_yes, obs_count, has_trend)
+            if gate == entry_gate.UPTREND or gate == entry_gate.STABLE:
                 log.info(
                     "Entrada [%s] %s — YES=%.1f¢ (%d obs)",
-                    entry_type, opp["question"][:35], rt_yes * 100, obs_count,
+                    "uptrend" if gate == entry_gate.UPTREND else "stable",
+                    opp["question"][:35], rt_yes * 100, obs_count,
                 )
                 clob_verified.append(opp)
-            elif ENTRY_YES_MIN <= rt_yes <= ENTRY_YES_MAX:
+            elif gate == entry_gate.PENDING:
                 log.info(
                     "Pendiente %s — YES=%.1f¢ en rango, %d obs (esperando trend o ≥%d)",
                     opp["question"][:35], rt_yes * 100, obs_count, TREND_MIN_OBSERVATIONS,
                 )
 
+        # len(display_opps) <= MAX_CLOB_VERIFY: completar hasta 20 sin re-slicing
         display_opps.extend(candidates[MAX_CLOB_VERIFY:MAX_CLOB_VERIFY + (20 - len(display_opps))])
 
-        self.last_opportunities = [
-            {
-                "question":  o["question"],
-                "yes_price": o["yes_price"],
-                "no_price":  o["no_price"],
-                "volume":    o["volume"],
-                "profit_cents": o.get("profit_cents", 0),
-                "trend_obs": o.get("trend_obs", 0),
-                "has_trend": o.get("has_trend", False),
-            }
-            for o in display_opps[:20]
-        ]
+        # Reconstruir la proyección para el dashboard solo si cambió algo
+        opps_key = tuple(_OPP_VIEW(o) for o in display_opps)
+        if opps_key != self._last_opps_key:
+            self._last_opps_key = opps_key
+            self.last_opportunities = tuple(dict(zip(_OPP_FIELDS, v)) for v in opps_key)
 
         # 4. Precios posiciones abiertas — CLOB → Gamma fallback
-        with portfolio.lock:
-            pos_data = [
-                (cid, pos.get("yes_token_id"), pos.get("slug"))
-                for cid, pos in portfolio.positions.items()
-            ]
-
-        price_map     = {}
-        clob_ok_pos   = True
-        clob_fail_pos = 0
-        for cid, yes_tid, slug in pos_data:
-            if self._stop_event.is_set():
-                return
-            yes_p, no_p = None, None
-            if clob_ok_pos and yes_tid:
-                yes_p, no_p = fetch_yes_price_clob(yes_tid)
-                if yes_p is not None and yes_p > 0.50:
-                    yes_p, no_p = None, None
-                if yes_p is None:
-                    clob_fail_pos += 1
-                    if clob_fail_pos >= 2:
-                        clob_ok_pos = False
-            if yes_p is None:
-                yes_p, no_p = fetch_live_prices(slug)
-            if yes_p is not None and no_p is not None:
-                price_map[cid] = (yes_p, no_p)
-
-        # 5. Portfolio operations (con lock)
-        with portfolio.lock:
-            for opp in clob_verified:
+        prices = self._fetch_prices_parallel(self._position_price_targets())
+        if prices is None:
+            return
+        price_map = {
+            cid: (yes_p, no_p)
+            for cid, (yes_p, no_p, _) in prices.items()
+            if no_p is not None
+        }
+
+        # 5. Portfolio operations — secciones críticas cortas; el lock se
+        #    libera entre fases para no bloquear al dashboard ni al price thread.
+        for opp in clob_verified:
+            city = opp.get("city", "")
+            with portfolio.lock:
                 if not portfolio.can_open_position():
                     break
-                city = opp.get("city", "")
-                if not portfolio.region_has_capacity(city):
-                    log.info("Región llena, skip %s (%s)", city, opp["question"][:30])
-                    continue
-                amount = calc_position_size(portfolio.capital_disponible, opp["yes_price"])
-                if amount >= 1:
+                has_capacity = portfolio.region_has_capacity(city)
+                capital_disponible = portfolio.capital_disponible
+            if not has_capacity:
+                log.info("Región llena, skip %s (%s)", city, opp["question"][:30])
+                continue
+            amount = calc_position_size(capital_disponible, opp["yes_price"])
+            if amount >= 1:
+                with portfolio.lock:
                     portfolio.open_position(opp, amount)
-                    log.info(
-                        "Abierta YES: %s @ %.1f¢  $%.2f",
-                        opp["question"][:40], opp["yes_price"] * 100, amount,
-                    )
+                log.info(
+                    "Abierta YES: %s @ %.1f¢  $%.2f",
+                    opp["question"][:40], opp["yes_price"] * 100, amount,
+                )
 
+        # Un solo timestamp para todas las escrituras de esta fase
+        now_iso = now_utc().isoformat()
+        with portfolio.lock:
             if price_map:
-                portfolio.apply_price_updates(price_map)
-
-            # Auto-liquidar posiciones fuera del rango de entrada
-            for cid, pos in list(portfolio.positions.items()):
-                entry_yes = pos.get("entry_yes", 0.0)
-                if not (ENTRY_YES_MIN <= entry_yes <= ENTRY_YES_MAX):
-                    current_yes = pos.get("current_yes", entry_yes)
-                    pnl = round(pos["tokens"] * current_yes - pos["allocated"], 2)
-                    log.warning(
-                        "Auto-liquidar %s — entrada YES=%.1f¢ fuera de rango",
-                        pos["question"][:40], entry_yes * 100,
-                    )
-                    portfolio._close_position(
-                        cid, "LIQUIDATED", pnl,
-                        resolution=(
-                            f"Auto-liquidación: YES entrada {entry_yes*100:.1f}¢ "
-                            f"fuera del rango ({ENTRY_YES_MIN*100:.0f}–{ENTRY_YES_MAX*100:.0f}¢)"
-                        ),
-                    )
-
-            portfolio.check_progressive_exits()
-            portfolio.record_capital()
+                portfolio.apply_price_updates(price_map, now_iso=now_iso)
+            pos_snapshot = [
+                (cid, pos["question"], pos.get("entry_yes", 0.0), pos.get("current_yes"),
+                 pos["tokens"], pos["allocated"])
+                for cid, pos in portfolio.positions.items()
+            ]
+
+        # Auto-liquidar posiciones fuera del rango de entrada
+        to_liquidate = []
+        for cid, question, entry_yes, current_yes, tokens, allocated in pos_snapshot:
+            if ENTRY_YES_MIN <= entry_yes <= ENTRY_YES_MAX:
+                continue
+            if current_yes is None:
+                current_yes = entry_yes
+            pnl = round(tokens * current_yes - allocated, 2)
+            log.warning(
+                "Auto-liquidar %s — entrada YES=%.1f¢ fuera de rango",
+                question[:40], entry_yes * 100,
+            )
+            to_liquidate.append((
+                cid, pnl,
+                f"Auto-liquidación: YES entrada {entry_yes*100:.1f}¢ "
+                f"fuera del rango ({ENTRY_YES_MIN*100:.0f}–{ENTRY_YES_MAX*100:.0f}¢)",
+            ))
+
+        with portfolio.lock:
+            for cid, pnl, resolution in to_liquidate:
+                portfolio._close_position(
+                    cid, "LIQUIDATED", pnl, resolution=resolution, now_iso=now_iso,
+                )
+            portfolio.check_progressive_exits(now_iso=now_iso)
+            portfolio.record_capital(now_iso=now_iso)
 
         tracker.purge_old()
 
+    # ── Price fetching ─────────────────────────────────────────────────────────
+
+    def _position_price_targets(self):
+        """Snapshot [(cid, yes_token_id, slug), ...] de las posiciones abiertas."""
+        with self.portfolio.lock:
+            return [
+                (cid, *_TOKEN_AND_SLUG(pos))
+                for cid, pos in self.portfolio.positions.items()
+            ]
+
+    def _fetch_prices_parallel(self, items, fallback=True):
+        """Precios YES/NO en paralelo para [(cid, yes_token_id, slug), ...].
+
+        Pasada 1: CLOB por yes_token_id (sanity: YES > 0.50 → token NO, descartar),
+                  salvo que CLOB_CB tenga el circuito abierto.
+        Pasada 2: Gamma por slug, solo para los que CLOB no resolvió (si fallback).
+        Devuelve {cid: (yes_price, no_price, source)} o None si se pidió stop.
+        """
+        results = {}
+        if CLOB_CB.allow():
+            clob = fetch_yes_prices_clob_batch(
+                [tid for _, tid, _ in items if tid], stop_event=self._stop_event,
+            )
+            if clob is None:
+                CLOB_CB.record_batch(0, 0)  # libera el probe half-open, si lo era
+                return None
+            # Solo cuentan los fallos del CLOB (transporte, 5xx, 429/403): un
+            # token sin book o descartado por sanity no dice nada de su salud.
+            reachable = [r for _, _, r in clob.values() if r is not None]
+            # requests concurrentes: un solo registro por lote
+            CLOB_CB.record_batch(sum(reachable), reachable.count(False))
+            for cid, yes_tid, _ in items:
+                if not yes_tid:
+                    continue
+                yes_p, no_p, _ = clob[yes_tid]
+                if yes_p is not None and yes_p <= 0.50:
+                    results[cid] = (yes_p, no_p, "CLOB")
+
+        if self._stop_event.is_set():
+            return None
+        if not fallback:
+            return results
+
+        missing = [(cid, slug) for cid, _, slug in items if cid not in results and slug]
+        gamma = fetch_live_prices_batch(
+            [slug for _, slug in missing], stop_event=self._stop_event,
+        )
+        if gamma is None:
+            return None
+        for cid, slug in missing:
+            yes_p, no_p = gamma[slug]
+            if yes_p is not None:
+                results[cid] = (yes_p, no_p, "Gamma")
+
+        if self._stop_event.is_set():
+            return None
+        return results
+
     # ── Price update loop ──────────────────────────────────────────────────────
 
     def _run_prices(self):
         log.info("Price updater V5 iniciado")
+        next_tick = time.monotonic()
         while not self._stop_event.is_set():
-            self._stop_event.wait(PRICE_UPDATE_INTERVAL)
+            next_tick = _next_tick(next_tick, PRICE_UPDATE_INTERVAL)
+            self._stop_event.wait(max(0.0, next_tick - time.monotonic()))
             if self._stop_event.is_set():
                 break
             try:
@@ -267,53 +343,27 @@ class BotRunner:
         log.info("Price updater V5 detenido")
 
     def _refresh_prices(self):
-        with self.portfolio.lock:
-            pos_data = [
-                (cid, pos.get("yes_token_id"), pos.get("slug"))
-                for cid, pos in self.portfolio.positions.items()
-            ]
-
-        clob_ok       = True
-        clob_failures = 0
-
-        for cid, yes_tid, slug in pos_data:
-            if self._stop_event.is_set():
-                return
-
-            yes_p, no_p = None, None
-            source = "Gamma"
-
-            if clob_ok and yes_tid:
-                yes_p, no_p = fetch_yes_price_clob(yes_tid)
-                if yes_p is not None:
-                    if yes_p > 0.50:
-                        yes_p, no_p = None, None
-                        clob_failures += 1
-                    else:
-                        source = "CLOB"
-                        clob_failures = 0
-                else:
-                    clob_failures += 1
-
-                if clob_failures >= 2:
-                    clob_ok = False
-                    log.warning("CLOB no confiable — usando Gamma para posiciones restantes")
-
-            if yes_p is None:
-                yes_p, no_p = fetch_live_prices(slug)
-
-            if yes_p is None:
-                continue
+        prices = self._fetch_prices_parallel(self._position_price_targets())
+        if prices is None:
+            return
 
-            with self.portfolio.lock:
-                if cid in self.portfolio.positions:
-                    pos = self.portfolio.positions[cid]
-                    old = pos["current_yes"]
-                    pos["current_yes"] = yes_p
-                    if abs(yes_p - old) >= 0.001:
-                        log.info(
-                            "Precio YES [%s] %s: %.4f → %.4f",
-                            source, slug[:30] if slug else cid[:20], old, yes_p,
-                        )
-
-        self.last_price_update = datetime.now(timezone.utc)
+        # Una sola sección crítica para todo el lote; logging fuera del lock
+        changes = []
+        with self.portfolio.lock:
+            positions = self.portfolio.positions
+            for cid, (yes_p, _, source) in prices.items():
+                pos = positions.get(cid)
+                if pos is None:
+                    continue
+                old = pos["current_yes"]
+                pos["current_yes"] = yes_p
+                if abs(yes_p - old) >= 0.001:
+                    changes.append((source, pos.get("slug"), cid, old, yes_p))
+
+        for source, slug, cid, old, yes_p in changes:
+            log.info(
+                "Precio YES [%s] %s: %.4f → %.4f",
+                source, slug[:30] if slug else cid[:20], old, yes_p,
+            )
+
+        self.last_price_update = now_utc()
@@ -0,0 +1,68 @@
+"""circuit.py — Circuit breaker compartido entre threads.
+
+Tras `trip_after` fallos consecutivos el circuito se abre y allow() devuelve
+False durante `recover_after_s` segundos; después deja pasar un solo lote
+de prueba (half-open) a la vez: un éxito lo cierra, un fallo lo vuelve a
+abrir. Quien recibe allow() == True debe llamar a record_batch().
+
+Los lotes de requests concurrentes se registran de una vez con record_batch():
+el orden dentro del lote no significa nada. Solo cuentan como fallo los de
+transporte o de servicio (excepción, timeout, 5xx, 429, 403), no un token
+sin precio.
+"""
+
+import logging
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+
+class CircuitBreaker:
+    def __init__(self, name, trip_after=2, recover_after_s=30):
+        self.name            = name
+        self.trip_after      = trip_after
+        self.recover_after_s = recover_after_s
+        self._failures  = 0
+        self._opened_at = None  # monotonic ts; None = cerrado
+        self._probe_at  = None  # monotonic ts del lote de prueba en curso
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            now = time.monotonic()
+            if now - self._opened_at < self.recover_after_s:
+                return False
+            # Half-open: un solo probe; si su record_batch() nunca llega,
+            # se concede otro tras recover_after_s.
+            if self._probe_at is not None and now - self._probe_at < self.recover_after_s:
+                return False
+            self._probe_at = now
+            return True
+
+    def record_batch(self, ok_count, fail_count):
+        """Un resultado por lote: cualquier éxito cierra el circuito; sin
+        éxitos, los fallos se suman a los consecutivos previos."""
+        with self._lock:
+            self._probe_at = None
+            if ok_count:
+                if self._opened_at is not None:
+                    log.info("%s recuperado — circuito cerrado", self.name)
+                self._failures  = 0
+                self._opened_at = None
+                return
+            if not fail_count:
+                return
+            self._failures += fail_count
+            if self._failures >= self.trip_after:
+                if self._opened_at is None:
+                    log.warning(
+                        "%s no confiable — circuito abierto %ds",
+                        self.name, self.recover_after_s,
+                    )
+                self._opened_at = time.monotonic()
+
+
+CLOB_CB = CircuitBreaker("CLOB")
@@ -38,6 +38,9 @@ POSITION_SIZE_MAX = float(os.environ.get("POSITION_SIZE_MAX", 0.027))
 # Price update thread
 PRICE_UPDATE_INTERVAL = int(os.environ.get("PRICE_UPDATE_INTERVAL", 10))
 
+# CLOB price cache — dedup de peticiones entre scan y price thread
+PRICE_CACHE_TTL = float(os.environ.get("PRICE_CACHE_TTL", 2.5))
+
 # Geographic correlation limits
 MAX_REGION_EXPOSURE = float(os.environ.get("MAX_REGION_EXPOSURE", 0.25))
 
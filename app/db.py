@@ -3,24 +3,34 @@
 Tablas:
   state            — capital actual (1 fila, siempre sobreescrita)
   open_positions   — posiciones activas (JSON blob por posición)
-  closed_positions — historial completo de trades (append-only, JSON blob)
+  closed_positions — historial completo de trades (append-only, JSON blob
+                     + columnas numéricas para agregados en SQL)
   capital_history  — curva de capital (un punto por hora aprox.)
 
+Los cierres se persisten en una sola transacción junto con open_positions
+y state (record_close()).
+
 DATABASE_PATH env var (default /data/portfolio.db).
 /data debe ser un Railway Volume para persistencia entre redeploys.
 Sin Volume: usa /tmp/portfolio.db (sobrevive reinicios, no redeploys).
 """
 
-import json
+import atexit
 import logging
 import os
 import sqlite3
+import threading
 from datetime import datetime, timezone
 
+import orjson
+
 log = logging.getLogger(__name__)
 
 _DB_PATH = os.environ.get("DATABASE_PATH", "/data/portfolio.db")
 
+_CONN = None
+_LOCK = threading.Lock()
+
 
 def _get_path():
     path = _DB_PATH
@@ -36,16 +46,31 @@ def _get_path():
 
 
 def _conn():
-    """Nueva conexión SQLite por operación (thread-safe)."""
-    return sqlite3.connect(_get_path())
+    """Conexión SQLite única y persistente (WAL, autocommit).
+
+    Se abre una vez (init_db) y se comparte entre threads: usar siempre
+    bajo _LOCK.
+    """
+    global _CONN
+    if _CONN is None:
+        _CONN = sqlite3.connect(
+            _get_path(), check_same_thread=False, isolation_level=None,
+        )
+        _CONN.executescript("""
+            PRAGMA journal_mode=WAL;
+            PRAGMA synchronous=NORMAL;
+            PRAGMA temp_store=MEMORY;
+            PRAGMA mmap_size=67108864;
+        """)
+        atexit.register(_CONN.close)
+    return _CONN
 
 
 def init_db():
-    """Crear tablas si no existen. Llamar al arrancar la app."""
-    path = _get_path()
-    log.info("DB: %s", path)
-    with _conn() as conn:
-        conn.executescript("""
+    """Abrir la conexión y crear tablas si no existen. Llamar al arrancar la app."""
+    log.info("DB: %s", _get_path())
+    with _LOCK:
+        _conn().executescript("""
             CREATE TABLE IF NOT EXISTS state (
                 id                  INTEGER PRIMARY KEY CHECK (id = 1),
                 capital_inicial     REAL,
@@ -64,7 +89,13 @@ def init_db():
                 close_time   TEXT,
                 status       TEXT,
                 pnl          REAL,
-                data         TEXT NOT NULL
+                data         TEXT NOT NULL,
+                entry_yes    REAL,
+                current_yes  REAL,
+                tokens       REAL,
+                allocated    REAL,
+                opened_at    TEXT,
+                city         TEXT
             );
             CREATE TABLE IF NOT EXISTS capital_history (
                 id      INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -72,27 +103,67 @@ def init_db():
                 capital REAL
             );
         """)
+        _migrate_closed_columns()
+
+
+# Columnas de closed_positions añadidas después del esquema original:
+# (columna, tipo, clave en el JSON de `data` para backfill)
+_CLOSED_EXTRA_COLUMNS = (
+    ("entry_yes",   "REAL", "entry_yes"),
+    ("current_yes", "REAL", "current_yes"),
+    ("tokens",      "REAL", "tokens"),
+    ("allocated",   "REAL", "allocated"),
+    ("opened_at",   "TEXT", "entry_time"),
+    ("city",        "TEXT", "city"),
+)
+
+
+def _migrate_closed_columns():
+    """Añade (y rellena desde el JSON) las columnas que falten en DBs antiguas.
+    Llamar bajo _LOCK."""
+    conn = _conn()
+    existing = {r[1] for r in conn.execute("PRAGMA table_info(closed_positions)")}
+    for col, col_type, key in _CLOSED_EXTRA_COLUMNS:
+        if col in existing:
+            continue
+        conn.execute(f"ALTER TABLE closed_positions ADD COLUMN {col} {col_type}")
+        conn.execute(
+            f"UPDATE closed_positions SET {col} = json_extract(data, '$.{key}')"
+        )
+        log.info("DB: columna closed_positions.%s añadida", col)
 
 
 # ── State ───────────────────────────────────────────────────────────────────────
 
-def save_state(capital_inicial, capital_total, capital_disponible, session_start):
-    now = datetime.now(timezone.utc).isoformat()
+_SAVE_STATE_SQL = """
+    INSERT INTO state
+        (id, capital_inicial, capital_total, capital_disponible,
+         session_start, updated_at)
+    VALUES (1, ?, ?, ?, ?, ?)
+    ON CONFLICT(id) DO UPDATE SET
+        capital_inicial    = excluded.capital_inicial,
+        capital_total      = excluded.capital_total,
+        capital_disponible = excluded.capital_disponible,
+        session_start      = excluded.session_start,
+        updated_at         = excluded.updated_at
+"""
+
+
+def _state_params(capital_inicial, capital_total, capital_disponible, session_start,
+                  now_iso=None):
+    now = now_iso or datetime.now(timezone.utc).isoformat()
     ss  = session_start.isoformat() if hasattr(session_start, "isoformat") else str(session_start)
+    return (capital_inicial, capital_total, capital_disponible, ss, now)
+
+
+def save_state(capital_inicial, capital_total, capital_disponible, session_start,
+               now_iso=None):
+    """now_iso: timestamp ya formateado del caller (evita otro datetime.now)."""
     try:
-        with _conn() as conn:
-            conn.execute("""
-                INSERT INTO state
-                    (id, capital_inicial, capital_total, capital_disponible,
-                     session_start, updated_at)
-                VALUES (1, ?, ?, ?, ?, ?)
-                ON CONFLICT(id) DO UPDATE SET
-                    capital_inicial    = excluded.capital_inicial,
-                    capital_total      = excluded.capital_total,
-                    capital_disponible = excluded.capital_disponible,
-                    session_start      = excluded.session_start,
-                    updated_at         = excluded.updated_at
-            """, (capital_inicial, capital_total, capital_disponible, ss, now))
+        params = _state_params(capital_inicial, capital_total, capital_disponible,
+                               session_start, now_iso)
+        with _LOCK:
+            _conn().execute(_SAVE_STATE_SQL, params)
     except Exception as e:
         log.warning("db.save_state: %s", e)
 
@@ -100,8 +171,8 @@ def save_state(capital_inicial, capital_total, capital_disponible, session_start
 def load_state():
     """Devuelve dict con capital fields o None si no hay datos."""
     try:
-        with _conn() as conn:
-            row = conn.execute(
+        with _LOCK:
+            row = _conn().execute(
                 "SELECT capital_inicial, capital_total, capital_disponible, session_start "
                 "FROM state WHERE id = 1"
             ).fetchone()
@@ -120,35 +191,28 @@ def load_state():
 
 # ── Open positions ───────────────────────────────────────────────────────────────
 
-def upsert_open_position(condition_id, data):
-    try:
-        with _conn() as conn:
-            conn.execute("""
-                INSERT INTO open_positions (condition_id, data) VALUES (?, ?)
-                ON CONFLICT(condition_id) DO UPDATE SET data = excluded.data
-            """, (condition_id, json.dumps(data)))
-    except Exception as e:
-        log.warning("db.upsert_open_position: %s", e)
+_UPSERT_OPEN_SQL = """
+    INSERT INTO open_positions (condition_id, data) VALUES (?, ?)
+    ON CONFLICT(condition_id) DO UPDATE SET data = excluded.data
+"""
 
 
-def delete_open_position(condition_id):
+def upsert_open_position(condition_id, data):
     try:
-        with _conn() as conn:
-            conn.execute(
-                "DELETE FROM open_positions WHERE condition_id = ?", (condition_id,)
-            )
+        with _LOCK:
+            _conn().execute(_UPSERT_OPEN_SQL, (condition_id, orjson.dumps(data).decode()))
     except Exception as e:
-        log.warning("db.delete_open_position: %s", e)
+        log.warning("db.upsert_open_position: %s", e)
 
 
 def load_open_positions():
     """Devuelve {condition_id: data_dict}."""
     try:
-        with _conn() as conn:
-            rows = conn.execute(
+        with _LOCK:
+            rows = _conn().execute(
                 "SELECT condition_id, data FROM open_positions"
             ).fetchall()
-        return {r[0]: json.loads(r[1]) for r in rows}
+        return {r[0]: orjson.loads(r[1]) for r in rows}
     except Exception as e:
         log.warning("db.load_open_positions: %s", e)
         return {}
@@ -156,42 +220,156 @@ def load_open_positions():
 
 # ── Closed positions ─────────────────────────────────────────────────────────────
 
-def insert_closed_position(pos):
+_INSERT_CLOSED_SQL = """
+    INSERT INTO closed_positions
+        (condition_id, close_time, status, pnl, data,
+         entry_yes, current_yes, tokens, allocated, opened_at, city)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+
+def _closed_row(pos):
+    return (
+        pos.get("condition_id", ""),
+        pos.get("close_time", ""),
+        pos.get("status", ""),
+        pos.get("pnl", 0.0),
+        orjson.dumps(pos).decode(),
+        pos.get("entry_yes"),
+        pos.get("current_yes"),
+        pos.get("tokens"),
+        pos.get("allocated"),
+        pos.get("entry_time"),
+        pos.get("city"),
+    )
+
+
+def record_close(closed, capital_inicial, capital_total, capital_disponible,
+                 session_start, now_iso=None, remaining=None):
+    """Persiste un cierre en una sola transacción.
+
+    Inserta el registro cerrado, borra la posición abierta (o guarda
+    `remaining`, la posición reducida de un cierre parcial) y actualiza state.
+    Un crash no puede dejar el capital actualizado sin su registro cerrado.
+    """
     try:
-        with _conn() as conn:
-            conn.execute("""
-                INSERT INTO closed_positions (condition_id, close_time, status, pnl, data)
-                VALUES (?, ?, ?, ?, ?)
-            """, (
-                pos.get("condition_id", ""),
-                pos.get("close_time", ""),
-                pos.get("status", ""),
-                pos.get("pnl", 0.0),
-                json.dumps(pos),
-            ))
+        cid = closed["condition_id"]
+        row = _closed_row(closed)
+        state = _state_params(capital_inicial, capital_total, capital_disponible,
+                              session_start, now_iso)
+        blob = orjson.dumps(remaining).decode() if remaining is not None else None
+        with _LOCK:
+            conn = _conn()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.execute(_INSERT_CLOSED_SQL, row)
+                if blob is None:
+                    conn.execute(
+                        "DELETE FROM open_positions WHERE condition_id = ?", (cid,)
+                    )
+                else:
+                    conn.execute(_UPSERT_OPEN_SQL, (cid, blob))
+                conn.execute(_SAVE_STATE_SQL, state)
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
     except Exception as e:
-        log.warning("db.insert_closed_position: %s", e)
+        log.warning("db.record_close: %s", e)
+
 
+def load_closed_positions(limit=200, offset=0):
+    """Devuelve una ventana de trades cerrados ordenada cronológicamente.
 
-def load_closed_positions():
-    """Devuelve lista de dicts ordenada cronológicamente."""
+    La ventana cuenta desde el más reciente: offset=0 son los últimos `limit`
+    trades.
+    """
     try:
-        with _conn() as conn:
-            rows = conn.execute(
-                "SELECT data FROM closed_positions ORDER BY id"
+        with _LOCK:
+            rows = _conn().execute(
+                "SELECT data FROM closed_positions ORDER BY id DESC LIMIT ? OFFSET ?",
+                (limit, offset),
             ).fetchall()
-        return [json.loads(r[0]) for r in rows]
+        return [orjson.loads(r[0]) for r in reversed(rows)]
     except Exception as e:
         log.warning("db.load_closed_positions: %s", e)
         return []
 
 
+def iter_closed_positions(batch=500):
+    """Recorre todo el historial cerrado en orden cronológico, de a `batch`
+    filas (keyset por id), sin materializarlo entero en memoria.
+
+    Lee solo las columnas que usa AutoPortfolio._index_closed() (sin parsear
+    el JSON de `data`): condition_id, status, pnl, entry_time y city.
+    """
+    last_id = 0
+    while True:
+        try:
+            with _LOCK:
+                rows = _conn().execute("""
+                    SELECT id, condition_id, status, pnl, opened_at, city
+                    FROM closed_positions WHERE id > ? ORDER BY id LIMIT ?
+                """, (last_id, batch)).fetchall()
+        except Exception as e:
+            log.warning("db.iter_closed_positions: %s", e)
+            return
+        for _, cid, status, pnl, opened_at, city in rows:
+            rec = {"condition_id": cid, "status": status, "pnl": pnl or 0.0,
+                   "entry_time": opened_at}
+            if city is not None:  # registros sin ciudad → "unknown" en insights
+                rec["city"] = city
+            yield rec
+        if len(rows) < batch:
+            return
+        last_id = rows[-1][0]
+
+
+def aggregate_stats():
+    """Agregados del historial cerrado calculados en SQL (sin parsear JSON).
+
+    won/lost excluyen los registros parciales y las liquidaciones, igual que
+    los contadores de AutoPortfolio._index_closed().
+    """
+    try:
+        with _LOCK:
+            row = _conn().execute("""
+                SELECT
+                    COUNT(*),
+                    COALESCE(SUM(pnl), 0),
+                    COALESCE(SUM(allocated), 0),
+                    AVG(entry_yes),
+                    COALESCE(SUM(pnl > 0  AND status NOT IN ('PARTIAL_1', 'PARTIAL_2', 'LIQUIDATED')), 0),
+                    COALESCE(SUM(pnl <= 0 AND status NOT IN ('PARTIAL_1', 'PARTIAL_2', 'LIQUIDATED')), 0),
+                    COALESCE(SUM(status = 'STOPPED'), 0),
+                    COALESCE(SUM(status = 'PARTIAL_1'), 0),
+                    COALESCE(SUM(status = 'PARTIAL_2'), 0),
+                    COALESCE(SUM(status = 'LIQUIDATED'), 0)
+                FROM closed_positions
+            """).fetchone()
+        return {
+            "records":        row[0],
+            "realized_pnl":   round(row[1], 2),
+            "allocated":      round(row[2], 2),
+            "avg_entry_yes":  round(row[3], 4) if row[3] is not None else None,
+            "won":            row[4],
+            "lost":           row[5],
+            "stopped":        row[6],
+            "partial1":       row[7],
+            "partial2":       row[8],
+            "liquidated":     row[9],
+        }
+    except Exception as e:
+        log.warning("db.aggregate_stats: %s", e)
+        return {}
+
+
 # ── Capital history ──────────────────────────────────────────────────────────────
 
 def append_capital_point(ts, capital):
     try:
-        with _conn() as conn:
-            conn.execute(
+        with _LOCK:
+            _conn().execute(
                 "INSERT INTO capital_history (ts, capital) VALUES (?, ?)",
                 (ts, capital),
             )
@@ -202,8 +380,8 @@ def append_capital_point(ts, capital):
 def load_capital_history(limit=500):
     """Devuelve últimos N puntos para el gráfico del dashboard."""
     try:
-        with _conn() as conn:
-            rows = conn.execute(
+        with _LOCK:
+            rows = _conn().execute(
                 "SELECT ts, capital FROM capital_history ORDER BY id DESC LIMIT ?",
                 (limit,),
             ).fetchall()
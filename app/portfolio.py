@@ -13,7 +13,7 @@ LOST: NO ≥ 0.99 (event didn't happen).
 
 import logging
 import threading
-from collections import defaultdict
+from collections import defaultdict, deque
 from datetime import datetime, timezone
 from app.scanner import now_utc
 from app.config import (
@@ -28,6 +28,8 @@ import app.db as db
 
 log = logging.getLogger(__name__)
 
+CAPITAL_HISTORY_LEN = 500  # puntos en memoria / enviados al dashboard
+
 
 class AutoPortfolio:
     def __init__(self, initial_capital):
@@ -36,11 +38,14 @@ class AutoPortfolio:
         self.capital_total = initial_capital
         self.capital_disponible = initial_capital
         self.positions = {}
-        self.closed_positions = []
+        self._by_stage = (set(), set(), set())  # cids abiertos por exit_stage
+        self._reset_closed_index()
+        self.region_exposure = defaultdict(float)  # {region: allocated abierto}
         self.session_start = now_utc()
-        self.capital_history = [
-            {"time": now_utc().isoformat(), "capital": initial_capital}
-        ]
+        self.capital_history = deque(
+            [{"time": now_utc().isoformat(), "capital": initial_capital}],
+            maxlen=CAPITAL_HISTORY_LEN,
+        )
         self._cap_record_count = 0
 
     def can_open_position(self):
@@ -48,13 +53,15 @@ class AutoPortfolio:
                 self.capital_disponible >= 1)
 
     def open_position(self, opp, amount):
+        now_iso = now_utc().isoformat()
         yes_price = opp["yes_price"]
         tokens = amount / yes_price
         max_gain = tokens * 1.0 - amount  # si YES llega a 1.00
 
         pos = {
             **opp,
-            "entry_time":    now_utc().isoformat(),
+            "region":        REGION_MAP.get(opp.get("city", ""), "other"),
+            "entry_time":    now_iso,
             "entry_yes":     yes_price,
             "current_yes":   yes_price,
             "allocated":     amount,
@@ -66,108 +73,138 @@ class AutoPortfolio:
         }
         cid = opp["condition_id"]
         self.positions[cid] = pos
+        self._by_stage[0].add(cid)
         self.capital_disponible -= amount
+        self._add_region_exposure(pos["region"], amount)
         db.upsert_open_position(cid, pos)
-        db.save_state(self.capital_inicial, self.capital_total,
-                      self.capital_disponible, self.session_start)
+        self.save_state(now_iso)
         return True
 
-    def apply_price_updates(self, price_map):
+    def apply_price_updates(self, price_map, now_iso=None):
         """Apply {cid: (yes_price, no_price)} and handle resolutions + stop loss.
         Must be called with self.lock held."""
         to_close = []
+        positions = self.positions
 
         for cid, (yes_price, no_price) in price_map.items():
-            if cid not in self.positions:
+            pos = positions.get(cid)
+            if pos is None:
                 continue
-            pos = self.positions[cid]
             pos["current_yes"] = yes_price
 
             # 1. YES resolvió → WON (el evento ocurrió)
             if yes_price >= 0.99:
-                sale_value = pos["tokens"] * yes_price
-                pnl = sale_value - pos["allocated"]
+                pnl = pos["tokens"] * yes_price - pos["allocated"]
                 resolution = f"YES resolvió — evento ocurrió (YES={yes_price*100:.1f}¢)"
                 to_close.append((cid, "WON", pnl, resolution))
+                continue
 
             # 2. NO resolvió → LOST (el evento no ocurrió)
-            elif no_price >= 0.99:
+            if no_price >= 0.99:
                 resolution = f"NO resolvió — evento no ocurrió (NO={no_price*100:.1f}¢)"
                 to_close.append((cid, "LOST", -pos["allocated"], resolution))
+                continue
 
             # 3. Stop loss: YES cae STOP_LOSS_DROP desde entrada
-            else:
-                drop = yes_price - pos["entry_yes"]
-                if drop <= -STOP_LOSS_DROP:
-                    sale_value = pos["tokens"] * yes_price
-                    realized_loss = sale_value - pos["allocated"]
-                    resolution = (
-                        f"Stop loss @ YES={yes_price*100:.1f}¢ "
-                        f"(entrada {pos['entry_yes']*100:.1f}¢, caída {-drop*100:.1f}¢)"
-                    )
-                    to_close.append((cid, "STOPPED", realized_loss, resolution))
+            entry_yes = pos["entry_yes"]
+            drop = yes_price - entry_yes
+            if drop > -STOP_LOSS_DROP:
+                continue  # caso común: nada que cerrar
+            realized_loss = pos["tokens"] * yes_price - pos["allocated"]
+            resolution = (
+                f"Stop loss @ YES={yes_price*100:.1f}¢ "
+                f"(entrada {entry_yes*100:.1f}¢, caída {-drop*100:.1f}¢)"
+            )
+            to_close.append((cid, "STOPPED", realized_loss, resolution))
 
+        if to_close and now_iso is None:
+            now_iso = now_utc().isoformat()
         for cid, status, pnl, resolution in to_close:
-            self._close_position(cid, status, pnl, resolution)
+            self._close_position(cid, status, pnl, resolution, now_iso=now_iso)
 
-    def _close_position(self, cid, status, pnl, resolution=""):
+    def _close_position(self, cid, status, pnl, resolution="", now_iso=None):
         if cid not in self.positions:
             return
+        if now_iso is None:
+            now_iso = now_utc().isoformat()
         pos = self.positions[cid]
-        pos["status"] = status
-        pos["pnl"] = pnl
-        pos["close_time"] = now_utc().isoformat()
-        pos["resolution"] = resolution
 
         recovered = pos["allocated"] + pnl
         self.capital_disponible += recovered
+        self._add_region_exposure(pos["region"], -pos["allocated"])
         self.capital_total += pnl
 
-        closed_pos = pos.copy()
-        self.closed_positions.append(closed_pos)
+        # Registro mínimo (como _partial_exit); current_yes/tokens van a columnas de DB
+        closed_pos = {
+            "question":     pos["question"],
+            "city":         pos.get("city", ""),
+            "condition_id": cid,
+            "entry_yes":    pos["entry_yes"],
+            "current_yes":  pos["current_yes"],
+            "tokens":       pos["tokens"],
+            "allocated":    pos["allocated"],
+            "pnl":          pnl,
+            "status":       status,
+            "resolution":   resolution,
+            "entry_time":   pos["entry_time"],
+            "close_time":   now_iso,
+        }
+        self._index_closed(closed_pos)
         del self.positions[cid]
-        db.delete_open_position(cid)
-        db.insert_closed_position(closed_pos)
-        db.save_state(self.capital_inicial, self.capital_total,
-                      self.capital_disponible, self.session_start)
+        self._by_stage[pos.get("exit_stage", 0)].discard(cid)
+        self._persist_close(closed_pos, now_iso)
 
     # ── Progressive 3-stage exits ─────────────────────────────────────────────
 
-    def check_progressive_exits(self):
+    def check_progressive_exits(self, now_iso=None):
         """Evaluate each position for the next exit stage (YES rising).
 
         Stage 0 → 1: sell 50% when YES ≥ EXIT_1_THRESHOLD (0.31)
         Stage 1 → 2: sell 50% of remaining when YES ≥ EXIT_2_THRESHOLD (0.37)
         Stage 2 → 3: close all when YES ≥ EXIT_3_THRESHOLD (0.43)
+
+        Recorre los buckets de _by_stage de mayor a menor: una posición que
+        sube de tramo en este tick no se vuelve a evaluar hasta el siguiente.
         """
-        for cid, pos in list(self.positions.items()):
-            stage = pos.get("exit_stage", 0)
-            current_yes = pos["current_yes"]
+        if now_iso is None:
+            now_iso = now_utc().isoformat()
+        positions = self.positions
+        stage0, stage1, stage2 = self._by_stage
 
-            if stage == 0 and current_yes >= EXIT_1_THRESHOLD:
-                self._partial_exit(cid, fraction=0.50, new_stage=1, label="PARTIAL_1")
-            elif stage == 1 and current_yes >= EXIT_2_THRESHOLD:
-                self._partial_exit(cid, fraction=0.50, new_stage=2, label="PARTIAL_2")
-            elif stage == 2 and current_yes >= EXIT_3_THRESHOLD:
-                remaining_pnl = pos["tokens"] * current_yes - pos["allocated"]
-                self._close_position(
-                    cid, "WON", remaining_pnl,
-                    resolution=(
-                        f"Tramo 3: cierre total @ YES={current_yes*100:.1f}¢ "
-                        f"(umbral {EXIT_3_THRESHOLD*100:.0f}¢)"
-                    ),
-                )
-
-    def _partial_exit(self, cid, fraction, new_stage, label):
+        for cid in [c for c in stage2 if positions[c]["current_yes"] >= EXIT_3_THRESHOLD]:
+            pos = positions[cid]
+            current_yes = pos["current_yes"]
+            remaining_pnl = pos["tokens"] * current_yes - pos["allocated"]
+            self._close_position(
+                cid, "WON", remaining_pnl,
+                resolution=(
+                    f"Tramo 3: cierre total @ YES={current_yes*100:.1f}¢ "
+                    f"(umbral {EXIT_3_THRESHOLD*100:.0f}¢)"
+                ),
+                now_iso=now_iso,
+            )
+        for cid in [c for c in stage1 if positions[c]["current_yes"] >= EXIT_2_THRESHOLD]:
+            self._partial_exit(cid, fraction=0.50, new_stage=2, label="PARTIAL_2",
+                               now_iso=now_iso)
+        for cid in [c for c in stage0 if positions[c]["current_yes"] >= EXIT_1_THRESHOLD]:
+            self._partial_exit(cid, fraction=0.50, new_stage=1, label="PARTIAL_1",
+                               now_iso=now_iso)
+
+    def _partial_exit(self, cid, fraction, new_stage, label, now_iso=None):
+        if now_iso is None:
+            now_iso = now_utc().isoformat()
         pos = self.positions[cid]
         tokens_sold = pos["tokens"] * fraction
         sale_value = tokens_sold * pos["current_yes"]
         cost_fraction = pos["allocated"] * fraction
         realized_pnl = sale_value - cost_fraction
 
+        self._add_region_exposure(pos["region"], -cost_fraction)
         pos["tokens"]    *= (1 - fraction)
         pos["allocated"] *= (1 - fraction)
         pos["max_gain"]  *= (1 - fraction)
+        self._by_stage[pos.get("exit_stage", 0)].discard(cid)
+        self._by_stage[new_stage].add(cid)
         pos["exit_stage"] = new_stage
 
         self.capital_disponible += cost_fraction + realized_pnl
@@ -185,22 +222,22 @@ class AutoPortfolio:
                 f"Salida {label}: {int(fraction*100)}% tokens @ YES={pos['current_yes']*100:.1f}¢"
             ),
             "entry_time": pos["entry_time"],
-            "close_time": now_utc().isoformat(),
+            "close_time": now_iso,
         }
-        self.closed_positions.append(partial_record)
-        db.insert_closed_position(partial_record)
-        db.upsert_open_position(cid, pos)  # actualizar posición reducida
-        db.save_state(self.capital_inicial, self.capital_total,
-                      self.capital_disponible, self.session_start)
+        self._index_closed(partial_record)
+        self._persist_close(partial_record, now_iso, remaining=pos)  # posición reducida
 
     # ── Region exposure ───────────────────────────────────────────────────────
 
+    def _add_region_exposure(self, region, delta):
+        total = self.region_exposure[region] + delta
+        if total > 1e-9:
+            self.region_exposure[region] = total
+        else:
+            del self.region_exposure[region]  # sin posiciones: evitar residuo float
+
     def get_region_allocated(self, region):
-        return sum(
-            pos["allocated"]
-            for pos in self.positions.values()
-            if REGION_MAP.get(pos.get("city", ""), "other") == region
-        )
+        return self.region_exposure.get(region, 0.0)
 
     def region_has_capacity(self, city):
         region = REGION_MAP.get(city, "other")
@@ -208,45 +245,64 @@ class AutoPortfolio:
 
     # ── Learning insights ─────────────────────────────────────────────────────
 
+    _INSIGHTS_EXCLUDE = frozenset({"PARTIAL_1", "PARTIAL_2", "LIQUIDATED"})
+
+    def _reset_closed_index(self):
+        """Índices derivados del historial cerrado (tabla closed_positions),
+        mantenidos incrementalmente. Los registros en sí no se guardan en memoria."""
+        self.closed_count = 0
+        self.closed_ids = set()  # condition_ids con algún registro cerrado
+        self._insights_by_hour = defaultdict(lambda: {"won": 0, "total": 0})
+        self._insights_by_city = defaultdict(lambda: {"won": 0, "total": 0})
+        self._insights_total = 0
+        self._insights_won   = 0
+        # conteos por status + "_won"/"_lost" (excluye parciales y liquidaciones)
+        self._status_counts = defaultdict(int)
+
+    def _index_closed(self, rec):
+        """Actualizar índices con un registro cerrado nuevo (o leído al cargar)."""
+        self.closed_count += 1
+        cid = rec.get("condition_id")
+        if cid:
+            self.closed_ids.add(cid)
+
+        status = rec["status"]
+        self._status_counts[status] += 1
+        if status in self._INSIGHTS_EXCLUDE:
+            return
+        self._status_counts["_won" if rec["pnl"] > 0 else "_lost"] += 1
+        try:
+            hour = int(rec["entry_time"][11:13])
+        except Exception:
+            hour = -1
+        won = status == "WON"
+
+        self._insights_total += 1
+        self._insights_won   += won
+        if hour >= 0:
+            by_hour = self._insights_by_hour[hour]
+            by_hour["total"] += 1
+            by_hour["won"]   += won
+        by_city = self._insights_by_city[rec.get("city", "unknown")]
+        by_city["total"] += 1
+        by_city["won"]   += won
+
     def compute_insights(self):
-        exclude = {"PARTIAL_1", "PARTIAL_2", "LIQUIDATED"}
-        closed = [p for p in self.closed_positions if p["status"] not in exclude]
-        if len(closed) < 5:
+        total = self._insights_total
+        if total < 5:
             return None
 
-        by_hour = defaultdict(lambda: {"won": 0, "total": 0})
-        by_city = defaultdict(lambda: {"won": 0, "total": 0})
-
-        for pos in closed:
-            try:
-                hour = int(pos["entry_time"][11:13])
-            except Exception:
-                hour = -1
-            city = pos.get("city", "unknown")
-            won = pos["status"] in ("WON",)
-
-            if hour >= 0:
-                by_hour[hour]["total"] += 1
-                if won:
-                    by_hour[hour]["won"] += 1
-            by_city[city]["total"] += 1
-            if won:
-                by_city[city]["won"] += 1
-
-        total = len(closed)
-        won_total = sum(1 for p in closed if p["status"] == "WON")
-
         return {
-            "overall_win_rate": round(won_total / total, 2),
+            "overall_win_rate": round(self._insights_won / total, 2),
             "total_trades": total,
             "by_hour": sorted(
                 [{"hour": h, "win_rate": round(v["won"] / v["total"], 2), "trades": v["total"]}
-                 for h, v in by_hour.items() if v["total"] >= 2],
+                 for h, v in self._insights_by_hour.items() if v["total"] >= 2],
                 key=lambda x: x["win_rate"], reverse=True,
             )[:6],
             "by_city": sorted(
                 [{"city": c, "win_rate": round(v["won"] / v["total"], 2), "trades": v["total"]}
-                 for c, v in by_city.items() if v["total"] >= 2],
+                 for c, v in self._insights_by_city.items() if v["total"] >= 2],
                 key=lambda x: x["win_rate"], reverse=True,
             )[:6],
         }
@@ -255,9 +311,15 @@ class AutoPortfolio:
 
     # ── State persistence ─────────────────────────────────────────────────────
 
-    def save_state(self):
+    def save_state(self, now_iso=None):
         db.save_state(self.capital_inicial, self.capital_total,
-                      self.capital_disponible, self.session_start)
+                      self.capital_disponible, self.session_start, now_iso=now_iso)
+
+    def _persist_close(self, closed, now_iso, remaining=None):
+        """Registro cerrado + open_positions + state en una transacción."""
+        db.record_close(closed, self.capital_inicial, self.capital_total,
+                        self.capital_disponible, self.session_start,
+                        now_iso=now_iso, remaining=remaining)
 
     def load_state(self):
         """Restaura estado desde DB al arrancar. Devuelve True si OK."""
@@ -269,14 +331,23 @@ class AutoPortfolio:
             self.capital_total      = s["capital_total"]
             self.capital_disponible = s["capital_disponible"]
             self.positions          = db.load_open_positions()
-            self.closed_positions   = db.load_closed_positions()
-            hist = db.load_capital_history()
+            self.region_exposure    = defaultdict(float)
+            self._by_stage          = (set(), set(), set())
+            for cid, pos in self.positions.items():
+                self._by_stage[pos.get("exit_stage", 0)].add(cid)
+                # posiciones guardadas antes de cachear la región
+                region = pos.setdefault("region", REGION_MAP.get(pos.get("city", ""), "other"))
+                self._add_region_exposure(region, pos["allocated"])
+            self._reset_closed_index()
+            for rec in db.iter_closed_positions():
+                self._index_closed(rec)
+            hist = db.load_capital_history(limit=CAPITAL_HISTORY_LEN)
             if hist:
-                self.capital_history = hist
+                self.capital_history = deque(hist, maxlen=CAPITAL_HISTORY_LEN)
             self.session_start = datetime.fromisoformat(s["session_start"])
             log.info(
                 "Estado restaurado desde DB: capital=%.2f  abiertas=%d  cerradas=%d",
-                self.capital_total, len(self.positions), len(self.closed_positions),
+                self.capital_total, len(self.positions), self.closed_count,
             )
             return True
         except Exception as e:
@@ -285,30 +356,42 @@ class AutoPortfolio:
 
     # ── Capital snapshot ──────────────────────────────────────────────────────
 
-    def record_capital(self):
-        ts = now_utc().isoformat()
+    def record_capital(self, now_iso=None):
+        ts = now_iso or now_utc().isoformat()
         point = {"time": ts, "capital": round(self.capital_total, 2)}
-        self.capital_history.append(point)
-        if len(self.capital_history) > 500:
-            self.capital_history = self.capital_history[-500:]
+        self.capital_history.append(point)  # deque acotada: descarta el más viejo
         self._cap_record_count += 1
         if self._cap_record_count % 120 == 0:  # cada ~1h (120 ciclos × 30s)
             db.append_capital_point(ts, round(self.capital_total, 2))
 
-    def snapshot(self):
-        pnl = self.capital_total - self.capital_inicial
-        roi = (pnl / self.capital_inicial * 100) if self.capital_inicial else 0
+    def _snapshot_raw(self):
+        """Copia superficial del estado. Llamar con self.lock tomado.
 
-        exclude = {"PARTIAL_1", "PARTIAL_2", "LIQUIDATED"}
-        won  = sum(1 for p in self.closed_positions if p["pnl"] > 0  and p["status"] not in exclude)
-        lost = sum(1 for p in self.closed_positions if p["pnl"] <= 0 and p["status"] not in exclude)
-        stopped    = sum(1 for p in self.closed_positions if p["status"] == "STOPPED")
-        partial1   = sum(1 for p in self.closed_positions if p["status"] == "PARTIAL_1")
-        partial2   = sum(1 for p in self.closed_positions if p["status"] == "PARTIAL_2")
-        liquidated = sum(1 for p in self.closed_positions if p["status"] == "LIQUIDATED")
+        Las posiciones abiertas se mutan (apply_price_updates): se copian.
+        El historial cerrado no viaja en el snapshot, solo su conteo; el
+        dashboard lo pide paginado a /api/closed_positions.
+        """
+        return {
+            "capital_inicial":    self.capital_inicial,
+            "capital_total":      self.capital_total,
+            "capital_disponible": self.capital_disponible,
+            "positions":          [pos.copy() for pos in self.positions.values()],
+            "closed_count":       self.closed_count,
+            "capital_history":    list(self.capital_history),
+            "insights":           self.compute_insights(),
+            "status_counts":      dict(self._status_counts),
+        }
+
+    def _format_snapshot(self, raw):
+        """Arma la respuesta de /api/status a partir de _snapshot_raw(), sin lock."""
+        capital_inicial = raw["capital_inicial"]
+        pnl = raw["capital_total"] - capital_inicial
+        roi = (pnl / capital_inicial * 100) if capital_inicial else 0
+
+        counts = raw["status_counts"]
 
         open_positions = []
-        for pos in list(self.positions.values()):
+        for pos in raw["positions"]:
             float_pnl = pos["tokens"] * pos["current_yes"] - pos["allocated"]
             open_positions.append({
                 "question":   pos["question"],
@@ -322,34 +405,21 @@ class AutoPortfolio:
                 "status":     pos["status"],
             })
 
-        closed = []
-        for pos in self.closed_positions:
-            closed.append({
-                "question":   pos["question"],
-                "entry_yes":  pos.get("entry_yes", 0),
-                "allocated":  round(pos["allocated"], 2),
-                "pnl":        round(pos["pnl"], 2),
-                "status":     pos["status"],
-                "resolution": pos.get("resolution", ""),
-                "entry_time": pos["entry_time"],
-                "close_time": pos.get("close_time", ""),
-            })
-
         return {
-            "capital_inicial":   round(self.capital_inicial, 2),
-            "capital_total":     round(self.capital_total, 2),
-            "capital_disponible": round(self.capital_disponible, 2),
+            "capital_inicial":   round(capital_inicial, 2),
+            "capital_total":     round(raw["capital_total"], 2),
+            "capital_disponible": round(raw["capital_disponible"], 2),
             "pnl":        round(pnl, 2),
             "roi":        round(roi, 2),
-            "won":        won,
-            "lost":       lost,
-            "stopped":    stopped,
-            "partial1":   partial1,
-            "partial2":   partial2,
-            "liquidated": liquidated,
+            "won":        counts.get("_won", 0),
+            "lost":       counts.get("_lost", 0),
+            "stopped":    counts.get("STOPPED", 0),
+            "partial1":   counts.get("PARTIAL_1", 0),
+            "partial2":   counts.get("PARTIAL_2", 0),
+            "liquidated": counts.get("LIQUIDATED", 0),
             "open_positions":   open_positions,
-            "closed_positions": closed,
-            "capital_history":  self.capital_history,
+            "closed_count":     raw["closed_count"],
+            "capital_history":  raw["capital_history"],
             "session_start":    self.session_start.isoformat(),
-            "insights":         self.compute_insights(),
+            "insights":         raw["insights"],
         }
@@ -0,0 +1,35 @@
+"""price_cache.py — Cache en proceso de precios CLOB por token (TTL corto).
+
+_cycle y _refresh_prices piden el mismo yes_token_id con pocos segundos de
+diferencia; con un TTL de ~2.5s la segunda petición sale de aquí en vez de
+ir al CLOB, sin llegar a servir precios viejos.
+"""
+
+import threading
+import time
+
+from app.config import PRICE_CACHE_TTL
+
+MAX_ENTRIES = 1000
+
+_cache: dict[str, tuple[float, float, float]] = {}  # {token_id: (ts, yes, no)}
+_lock = threading.Lock()
+
+
+def get(token_id):
+    """(yes_price, no_price) si hay un precio más reciente que el TTL, si no None."""
+    with _lock:
+        entry = _cache.get(token_id)
+    if entry is None or time.monotonic() - entry[0] >= PRICE_CACHE_TTL:
+        return None
+    return entry[1], entry[2]
+
+
+def put(token_id, yes_price, no_price):
+    now = time.monotonic()
+    with _lock:
+        _cache[token_id] = (now, yes_price, no_price)
+        if len(_cache) > MAX_ENTRIES:
+            cutoff = now - PRICE_CACHE_TTL
+            for tid in [t for t, e in _cache.items() if e[0] < cutoff]:
+                del _cache[tid]
@@ -1,4 +1,7 @@
-from flask import Blueprint, render_template, jsonify
+import orjson
+from flask import Blueprint, Response, render_template, jsonify, request
+
+from app import db
 
 bp = Blueprint("main", __name__)
 
@@ -7,6 +10,12 @@ portfolio = None
 tracker = None
 
 
+def _orjson_response(obj):
+    """Como jsonify pero serializando con orjson (payloads grandes y frecuentes)."""
+    return Response(orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS),
+                    mimetype="application/json")
+
+
 def init_routes(bot_instance, portfolio_instance, tracker_instance):
     global bot, portfolio, tracker
     bot = bot_instance
@@ -22,7 +31,8 @@ def dashboard():
 @bp.route("/api/status")
 def api_status():
     with portfolio.lock:
-        snap = portfolio.snapshot()
+        raw = portfolio._snapshot_raw()
+    snap = portfolio._format_snapshot(raw)
     snap["bot_status"]   = bot.status if bot else "unknown"
     snap["scan_count"]   = bot.scan_count if bot else 0
     snap["last_opportunities"] = bot.last_opportunities if bot else []
@@ -40,7 +50,19 @@ def api_status():
         snap["tracked_markets"] = 0
         snap["trend_ready"]     = 0
 
-    return jsonify(snap)
+    return _orjson_response(snap)
+
+
+@bp.route("/api/closed_positions")
+def api_closed_positions():
+    limit  = min(max(request.args.get("limit", 200, type=int), 1), 1000)
+    offset = max(request.args.get("offset", 0, type=int), 0)
+    return jsonify(db.load_closed_positions(limit=limit, offset=offset))
+
+
+@bp.route("/api/stats")
+def api_stats():
+    return jsonify(db.aggregate_stats())
 
 
 @bp.route("/api/bot/start", methods=["POST"])
@@ -58,5 +80,5 @@ def api_bot_stop():
 @bp.route("/api/trends")
 def api_trends():
     if not tracker:
-        return jsonify({})
-    return jsonify(tracker.all_tracked())
+        return _orjson_response({})
+    return _orjson_response(tracker.all_tracked())
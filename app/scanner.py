@@ -1,8 +1,15 @@
 import requests
-import json
+import orjson
 import logging
+import re
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor, wait
 from datetime import datetime, timezone, timedelta
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ConnectTimeoutError, MaxRetryError, ReadTimeoutError
+from urllib3.util.retry import Retry
 
+from app import price_cache
 from app.config import (
     GAMMA, WEATHER_CITIES, ENTRY_YES_MIN, ENTRY_YES_MAX,
     MIN_VOLUME, SCAN_DAYS_AHEAD, CITY_UTC_OFFSET, MIN_LOCAL_HOUR,
@@ -12,22 +19,110 @@ CLOB = "https://clob.polymarket.com"
 log = logging.getLogger(__name__)
 
 
+class _ResetOnlyRetry(Retry):
+    """Reintenta conexiones reseteadas (p.ej. keep-alive cerrado por el
+    servidor) pero nunca timeouts ni conexiones fallidas: el presupuesto
+    (connect, read) de cada request no se multiplica.
+
+    En urllib3 2.x NewConnectionError/NameResolutionError heredan de
+    ConnectTimeoutError, así que connection refused y DNS tampoco se
+    reintentan. Esos se envuelven en MaxRetryError para que requests los
+    traduzca a ConnectTimeout/ConnectionError; ReadTimeoutError se re-levanta
+    tal cual y requests lo traduce a ReadTimeout.
+    """
+
+    def increment(self, method=None, url=None, response=None, error=None,
+                  _pool=None, _stacktrace=None):
+        if isinstance(error, ReadTimeoutError):
+            raise error
+        if isinstance(error, ConnectTimeoutError):
+            raise MaxRetryError(_pool, url, error) from error
+        return super().increment(method, url, response, error, _pool, _stacktrace)
+
+
+# Sesión HTTP compartida: keep-alive + pool de conexiones para Gamma y CLOB
+# (evita un handshake TCP+TLS por request).
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(
+    pool_connections=16, pool_maxsize=32,
+    max_retries=_ResetOnlyRetry(total=1, backoff_factor=0.1),
+))
+
+# Pool de threads para lecturas concurrentes sobre _SESSION (CLOB no tiene
+# endpoint batch: se paraleliza un GET /book por token).
+FETCH_WORKERS = 16
+_POOL = ThreadPoolExecutor(max_workers=FETCH_WORKERS, thread_name_prefix="scanner-fetch")
+
+# Pool aparte para descubrir eventos (GET /events, timeout 5+8s): un Gamma lento
+# no debe encolar los refresh de precios (stop-loss) que usan _POOL.
+EVENT_FETCH_WORKERS = 8
+_EVENT_POOL = ThreadPoolExecutor(max_workers=EVENT_FETCH_WORKERS,
+                                 thread_name_prefix="scanner-events")
+
+# Cada cuánto se mira stop_event mientras se espera un lote
+_STOP_POLL_S = 0.25
+
+
+def _fetch_many(fn, keys, pool=_POOL, stop_event=None):
+    """Aplica fn a cada key única en paralelo. Devuelve {key: fn(key)}.
+
+    Si stop_event se activa antes de terminar, cancela los futures que aún
+    no arrancaron y devuelve None sin esperar a los que están en vuelo.
+    """
+    if stop_event is not None and stop_event.is_set():
+        return None
+    keys = list(dict.fromkeys(keys))
+    if len(keys) <= 1:
+        return {k: fn(k) for k in keys}
+    if stop_event is None:
+        return dict(zip(keys, pool.map(fn, keys)))
+    futures = [pool.submit(fn, k) for k in keys]
+    pending = futures
+    while pending:
+        if stop_event.is_set():
+            for f in pending:
+                f.cancel()
+            return None
+        pending = wait(pending, timeout=_STOP_POLL_S).not_done
+    return dict(zip(keys, (f.result() for f in futures)))
+
+
 def now_utc():
     return datetime.now(timezone.utc)
 
 
 def parse_price(val):
+    # Camino rápido para valores ya numéricos (p.ej. volume); strings van a float()
+    t = type(val)
+    if t is float:
+        return val
+    if t is int:
+        return float(val)
+    if val is None or val == "":
+        return None
     try:
         return float(val)
     except Exception:
         return None
 
 
+_ISO_RE = re.compile(r"\d{4}-\d{2}-\d{2}")
+
+
+@lru_cache(maxsize=4096)
+def _parse_iso_cached(s):
+    # endDate se repite scan tras scan: cachear el datetime (inmutable)
+    return datetime.fromisoformat(s.replace("Z", "+00:00"))
+
+
 def parse_date(val):
     if not val:
         return None
+    s = str(val)
+    if not _ISO_RE.match(s):
+        return None
     try:
-        return datetime.fromisoformat(str(val).replace("Z", "+00:00"))
+        return _parse_iso_cached(s)
     except Exception:
         return None
 
@@ -35,7 +130,7 @@ def parse_date(val):
 def get_prices(m):
     raw = m.get("outcomePrices") or "[]"
     try:
-        prices = json.loads(raw) if isinstance(raw, str) else raw
+        prices = orjson.loads(raw) if isinstance(raw, str) else raw
         yes = parse_price(prices[0]) if len(prices) > 0 else None
         no  = parse_price(prices[1]) if len(prices) > 1 else None
         if yes is not None and yes < 0:
@@ -51,26 +146,37 @@ def get_prices(m):
         return None, None
 
 
-def city_is_ready(city, scan_date, today):
-    offset = CITY_UTC_OFFSET.get(city)
-    if offset is None:
-        return False
-    local_now = now_utc() + timedelta(hours=offset)
-    return local_now.date() == scan_date and local_now.hour >= MIN_LOCAL_HOUR
+def city_ready_dates(now):
+    """{city: fecha local} para las ciudades ya pasadas MIN_LOCAL_HOUR.
 
+    Una sola pasada por ciudad por scan; cada ciudad está lista como mucho
+    para una scan_date (su fecha local actual).
+    """
+    ready = {}
+    for city in WEATHER_CITIES:
+        offset = CITY_UTC_OFFSET.get(city)
+        if offset is None:
+            continue
+        local_now = now + timedelta(hours=offset)
+        if local_now.hour >= MIN_LOCAL_HOUR:
+            ready[city] = local_now.date()
+    return ready
+
+
+_MONTHS = (
+    None, "january", "february", "march", "april", "may", "june",
+    "july", "august", "september", "october", "november", "december",
+)
 
+
+@lru_cache(maxsize=512)
 def build_event_slug(city, date):
-    months = {
-        1: "january", 2: "february", 3: "march", 4: "april",
-        5: "may", 6: "june", 7: "july", 8: "august",
-        9: "september", 10: "october", 11: "november", 12: "december",
-    }
-    return f"highest-temperature-in-{city}-on-{months[date.month]}-{date.day}-{date.year}"
+    return f"highest-temperature-in-{city}-on-{_MONTHS[date.month]}-{date.day}-{date.year}"
 
 
 def fetch_event_by_slug(slug):
     try:
-        r = requests.get(
+        r = _SESSION.get(
             f"{GAMMA}/events", params={"slug": slug, "limit": 1},
             timeout=(5, 8),
         )
@@ -85,7 +191,7 @@ def fetch_event_by_slug(slug):
 
 def fetch_market_live(slug):
     try:
-        r = requests.get(
+        r = _SESSION.get(
             f"{GAMMA}/markets", params={"slug": slug, "limit": 1},
             timeout=(5, 8),
         )
@@ -110,19 +216,33 @@ def fetch_yes_price_clob(yes_token_id):
     """Fetch real-time YES price from CLOB order book.
 
     Uses best ASK = "Buy Yes" price.
-    Sanity: discard if YES > 0.50 (likely fetched NO token).
-    Returns (yes_price, no_price).
+    Returns (yes_price, no_price, reachable). Successful reads are cached
+    for PRICE_CACHE_TTL seconds.
+
+    reachable=False si el CLOB no respondió o no está sirviendo (excepción,
+    timeout, 5xx, 429, 403); un 404 o un book vacío es True (CLOB sano, sin precio para ese token) y
+    un acierto de cache es None (no dice nada sobre el CLOB).
     """
     if not yes_token_id:
-        return None, None
+        return None, None, None
+    cached = price_cache.get(yes_token_id)
+    if cached is not None:
+        return cached[0], cached[1], None
     try:
-        r = requests.get(
+        r = _SESSION.get(
             f"{CLOB}/book",
             params={"token_id": yes_token_id},
             timeout=(2, 3),
         )
-        if r.status_code != 200:
-            return None, None
+    except Exception:
+        log.debug("CLOB fetch failed for YES token %s", str(yes_token_id)[:20])
+        return None, None, False
+    # 5xx, rate limit (429) o rechazo del edge (403): el CLOB no está sirviendo
+    if r.status_code >= 500 or r.status_code in (403, 429):
+        return None, None, False
+    if r.status_code != 200:
+        return None, None, True
+    try:
         data = r.json()
 
         bids = data.get("bids") or []
@@ -137,82 +257,110 @@ def fetch_yes_price_clob(yes_token_id):
             ltp = data.get("last_trade_price")
             if ltp:
                 yes_price = float(ltp)
+    except Exception:
+        log.debug("CLOB book malformado para YES token %s", str(yes_token_id)[:20])
+        return None, None, True
 
-        if yes_price is None or not (0.0 < yes_price < 1.0):
-            return None, None
+    if yes_price is None or not (0.0 < yes_price < 1.0):
+        return None, None, True
 
-        no_price = round(1.0 - yes_price, 6)
-        return yes_price, no_price
+    no_price = round(1.0 - yes_price, 6)
+    price_cache.put(yes_token_id, yes_price, no_price)
+    return yes_price, no_price, True
+
+
+def fetch_yes_prices_clob_batch(token_ids, stop_event=None):
+    """fetch_yes_price_clob concurrente. Devuelve {token_id: (yes, no, reachable)},
+    o None si stop_event se activó."""
+    return _fetch_many(fetch_yes_price_clob, [t for t in token_ids if t],
+                       stop_event=stop_event)
 
-    except Exception:
-        log.debug("CLOB fetch failed for YES token %s", str(yes_token_id)[:20])
-        return None, None
 
+def fetch_live_prices_batch(slugs, stop_event=None):
+    """fetch_live_prices concurrente. Devuelve {slug: (yes, no)}, o None si
+    stop_event se activó."""
+    return _fetch_many(fetch_live_prices, [s for s in slugs if s],
+                       stop_event=stop_event)
 
-def scan_opportunities(existing_ids=None):
+
+def scan_opportunities(existing_ids=None, stop_event=None):
     """Scan for YES-side momentum opportunities (YES 0.10–0.40).
 
     Wide Gamma filter to build trend history for markets approaching entry range.
     CLOB in bot.py is the real entry gate (YES 0.22–0.27).
     Sorted by proximity to entry range center (YES=0.245).
+    Returns None if stop_event is set before the event fetches finish.
     """
     if existing_ids is None:
         existing_ids = set()
 
-    today = now_utc().date()
+    now = now_utc()
+    today = now.date()
     scan_dates = [today + timedelta(days=d) for d in range(SCAN_DAYS_AHEAD + 1)]
+    ready = city_ready_dates(now)
     opportunities = []
 
-    for scan_date in scan_dates:
-        for city in WEATHER_CITIES:
-            if not city_is_ready(city, scan_date, today):
+    targets = [
+        (city, build_event_slug(city, scan_date))
+        for scan_date in scan_dates
+        for city in WEATHER_CITIES
+        if ready.get(city) == scan_date
+    ]
+    # Un GET por evento, en paralelo (pool propio, sesión compartida)
+    events = _fetch_many(fetch_event_by_slug, [slug for _, slug in targets],
+                         pool=_EVENT_POOL, stop_event=stop_event)
+    if events is None:
+        return None
+
+    for city, slug in targets:
+        event = events[slug]
+        if not event:
+            continue
+
+        for m in (event.get("markets") or []):
+            condition_id = m.get("conditionId")
+            if condition_id in existing_ids:
+                continue
+
+            yes_price, no_price = get_prices(m)
+            if yes_price is None or no_price is None:
                 continue
-            slug = build_event_slug(city, scan_date)
-            event = fetch_event_by_slug(slug)
-            if not event:
+
+            # Wide Gamma filter: YES 0.10–0.40 (= NO 0.60–0.90)
+            # Catches markets approaching entry range from below so
+            # trend_tracker can build history before entry.
+            # Va antes que volumen: descarta la mayoría sin parsear nada más.
+            if not (0.10 <= yes_price <= 0.40):
+                continue
+
+            volume = parse_price(m.get("volume") or 0) or 0
+            if volume < MIN_VOLUME:
+                continue
+
+            end_dt = parse_date(m.get("endDate"))
+            if end_dt and end_dt.date() < today:
                 continue
 
-            for m in (event.get("markets") or []):
-                condition_id = m.get("conditionId")
-                if condition_id in existing_ids:
-                    continue
-
-                yes_price, no_price = get_prices(m)
-                if yes_price is None or no_price is None:
-                    continue
-
-                volume = parse_price(m.get("volume") or 0) or 0
-                if volume < MIN_VOLUME:
-                    continue
-
-                # Wide Gamma filter: YES 0.10–0.40 (= NO 0.60–0.90)
-                # Catches markets approaching entry range from below so
-                # trend_tracker can build history before entry.
-                if not (0.10 <= yes_price <= 0.40):
-                    continue
-
-                end_dt = parse_date(m.get("endDate"))
-                if end_dt and end_dt.date() < today:
-                    continue
-
-                raw_ids = m.get("clobTokenIds") or "[]"
-                clob_ids = json.loads(raw_ids) if isinstance(raw_ids, str) else raw_ids
-                yes_token_id = clob_ids[0] if len(clob_ids) > 0 else None
-                no_token_id  = clob_ids[1] if len(clob_ids) > 1 else None
-
-                opportunities.append({
-                    "condition_id": condition_id,
-                    "city": city,
-                    "question": m.get("question", ""),
-                    "yes_price": yes_price,
-                    "no_price": no_price,
-                    "volume": volume,
-                    "end_date": end_dt.isoformat() if end_dt else None,
-                    "slug": m.get("slug", ""),
-                    "profit_cents": round((yes_price) * 100, 1),
-                    "yes_token_id": yes_token_id,
-                    "no_token_id":  no_token_id,
-                })
+            raw_ids = m.get("clobTokenIds") or "[]"
+            clob_ids = orjson.loads(raw_ids) if isinstance(raw_ids, str) else raw_ids
+            yes_token_id = clob_ids[0] if len(clob_ids) > 0 else None
+            no_token_id  = clob_ids[1] if len(clob_ids) > 1 else None
+
+            opportunities.append({
+                "condition_id": condition_id,
+                "city": city,
+                "question": m.get("question", ""),
+                "yes_price": yes_price,
+                "no_price": no_price,
+                "volume": volume,
+                "end_date": end_dt.isoformat() if end_dt else None,
+                "slug": m.get("slug", ""),
+                "profit_cents": round((yes_price) * 100, 1),
+                "yes_token_id": yes_token_id,
+                "no_token_id":  no_token_id,
+                "trend_obs": 0,
+                "has_trend": False,
+            })
 
     # Sort: markets closest to entry range center (YES=0.245) first
     CENTER_YES = (ENTRY_YES_MIN + ENTRY_YES_MAX) / 2
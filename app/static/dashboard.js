@@ -130,9 +130,12 @@ function updateUI(data) {
         }).join("");
     }
 
-    // Closed trades
+    // Closed trades: paginados desde /api/closed_positions, solo si cambió el conteo
+    if (data.closed_count !== closedCount) fetchClosed(data.closed_count);
+}
+
+function renderClosed(closed) {
     const closedTb = $id("table-closed");
-    const closed   = data.closed_positions || [];
     if (closed.length === 0) {
         closedTb.innerHTML = "";
         $id("no-closed").classList.remove("hidden");
@@ -167,6 +170,34 @@ async function fetchStatus() {
     } catch(e) { console.error(e); }
 }
 
+// --- Closed trades pager ---
+const CLOSED_PAGE = 200;
+let closedCount  = null;  // conteo del último render
+let closedOffset = 0;     // 0 = los CLOSED_PAGE trades más recientes
+
+async function fetchClosed(count) {
+    try {
+        const res = await fetch(`/api/closed_positions?limit=${CLOSED_PAGE}&offset=${closedOffset}`);
+        if (!res.ok) return;
+        renderClosed(await res.json());
+        closedCount = count;
+        renderClosedPager();
+    } catch(e) { console.error(e); }
+}
+
+function renderClosedPager() {
+    const total  = closedCount || 0;
+    const newest = total - closedOffset;
+    const oldest = Math.max(newest - CLOSED_PAGE + 1, 1);
+    $id("closed-pager").classList.toggle("hidden", total <= CLOSED_PAGE);
+    $id("closed-range").textContent = `Trades ${oldest}–${newest} de ${total}`;
+    $id("btn-closed-newer").disabled = closedOffset === 0;
+    $id("btn-closed-older").disabled = closedOffset + CLOSED_PAGE >= total;
+}
+
+function closedNewer() { closedOffset = Math.max(closedOffset - CLOSED_PAGE, 0); fetchClosed(closedCount); }
+function closedOlder() { closedOffset += CLOSED_PAGE; fetchClosed(closedCount); }
+
 function winRateBar(rate) {
     const pct   = (rate * 100).toFixed(0);
     const color = rate >= 0.7 ? "bg-emerald-500" : rate >= 0.5 ? "bg-yellow-500" : "bg-red-500";
@@ -7,6 +7,7 @@ monotonically increasing AND total rise >= TREND_MIN_RISE.
 
 import threading
 import logging
+from collections import deque
 from datetime import datetime, timezone
 
 from app.config import TREND_MIN_RISE, TREND_MIN_OBSERVATIONS, PRICE_HISTORY_TTL
@@ -22,65 +23,88 @@ def _now_ts() -> float:
 
 class TrendTracker:
     def __init__(self):
-        self._history: dict[str, list[tuple[float, float]]] = {}  # {cid: [(ts, yes_price), ...]}
+        # {cid: deque([(ts, yes_price), ...], maxlen=MAX_HISTORY_PER_MARKET)}
+        self._history: dict[str, deque[tuple[float, float]]] = {}
+        # {cid: (obs_count, has_uptrend)} — recalculado solo en record()
+        self._stats: dict[str, tuple[int, bool]] = {}
+        # {cid: nº de subidas estrictas consecutivas que terminan en la última obs}
+        self._rising: dict[str, int] = {}
         self._lock = threading.Lock()
 
     def record(self, condition_id: str, yes_price: float):
         """Add a CLOB YES price observation for a market."""
+        self.record_many([(condition_id, yes_price)])
+
+    def record_many(self, observations) -> dict[str, tuple[int, bool]]:
+        """Record [(condition_id, yes_price), ...] under a single lock.
+
+        Returns {condition_id: (observation_count, has_uptrend)} after recording.
+        """
         ts = _now_ts()
+        result = {}
         with self._lock:
-            if condition_id not in self._history:
-                self._history[condition_id] = []
-            hist = self._history[condition_id]
-            hist.append((ts, yes_price))
-            if len(hist) > MAX_HISTORY_PER_MARKET:
-                self._history[condition_id] = hist[-MAX_HISTORY_PER_MARKET:]
+            for condition_id, yes_price in observations:
+                result[condition_id] = self._record_locked(condition_id, yes_price, ts)
+        return result
+
+    def _record_locked(self, condition_id, yes_price, ts):
+        hist = self._history.get(condition_id)
+        if hist is None:
+            hist = self._history[condition_id] = deque(maxlen=MAX_HISTORY_PER_MARKET)
+            rising = 0
+        elif yes_price > hist[-1][1]:
+            rising = self._rising[condition_id] + 1
+        else:
+            rising = 0
+        hist.append((ts, yes_price))
+        self._rising[condition_id] = rising
+
+        # Uptrend = últimas TREND_MIN_OBSERVATIONS obs estrictamente crecientes
+        # (racha ≥ K-1 subidas) y subida total ≥ TREND_MIN_RISE: O(1) por obs.
+        n = len(hist)
+        has_trend = (
+            n >= TREND_MIN_OBSERVATIONS
+            and rising >= TREND_MIN_OBSERVATIONS - 1
+            and yes_price - hist[n - TREND_MIN_OBSERVATIONS][1] >= TREND_MIN_RISE
+        )
+        stats = self._stats[condition_id] = (n, has_trend)
+        return stats
+
+    def stats(self, condition_id: str) -> tuple[int, bool]:
+        """(observation_count, has_uptrend) en una sola lectura.
+
+        Sin lock: record() reemplaza la tupla entera y dict.get es atómico
+        bajo el GIL, así que se lee el valor previo o el nuevo, nunca uno a
+        medias (a lo sumo una observación de retraso — válido para el gate).
+        """
+        return self._stats.get(condition_id, (0, False))
 
     def has_uptrend(self, condition_id: str) -> bool:
         """True if last TREND_MIN_OBSERVATIONS YES prices are strictly increasing
         and total rise >= TREND_MIN_RISE."""
-        with self._lock:
-            hist = self._history.get(condition_id, [])
-
-        if len(hist) < TREND_MIN_OBSERVATIONS:
-            return False
-
-        window = [price for _, price in hist[-TREND_MIN_OBSERVATIONS:]]
-
-        for i in range(1, len(window)):
-            if window[i] <= window[i - 1]:
-                return False
-
-        return (window[-1] - window[0]) >= TREND_MIN_RISE
+        return self.stats(condition_id)[1]
 
     def observation_count(self, condition_id: str) -> int:
-        with self._lock:
-            return len(self._history.get(condition_id, []))
+        return self.stats(condition_id)[0]
 
     def all_tracked(self) -> dict[str, dict]:
-        result = {}
+        # Bajo el lock solo se leen escalares (una pasada, trend ya cacheado);
+        # redondeo y construcción de dicts van fuera del lock.
         with self._lock:
-            for cid, hist in self._history.items():
-                if not hist:
-                    continue
-                prices = [p for _, p in hist]
-                result[cid] = {
-                    "observations": len(hist),
-                    "first_price": round(prices[0], 4),
-                    "last_price": round(prices[-1], 4),
-                    "total_rise": round(prices[-1] - prices[0], 4),
-                    "has_uptrend": self._check_uptrend(hist),
-                }
-        return result
-
-    def _check_uptrend(self, hist):
-        if len(hist) < TREND_MIN_OBSERVATIONS:
-            return False
-        window = [price for _, price in hist[-TREND_MIN_OBSERVATIONS:]]
-        for i in range(1, len(window)):
-            if window[i] <= window[i - 1]:
-                return False
-        return (window[-1] - window[0]) >= TREND_MIN_RISE
+            rows = [
+                (cid, len(hist), hist[0][1], hist[-1][1], self._stats[cid][1])
+                for cid, hist in self._history.items() if hist
+            ]
+        return {
+            cid: {
+                "observations": n,
+                "first_price": round(first_price, 4),
+                "last_price": round(last_price, 4),
+                "total_rise": round(last_price - first_price, 4),
+                "has_uptrend": has_trend,
+            }
+            for cid, n, first_price, last_price, has_trend in rows
+        }
 
     def purge_old(self):
         cutoff = _now_ts() - PRICE_HISTORY_TTL
@@ -91,5 +115,7 @@ class TrendTracker:
             ]
             for cid in to_delete:
                 del self._history[cid]
+                del self._stats[cid]
+                del self._rising[cid]
         if to_delete:
             log.info("TrendTracker purged %d stale market histories", len(to_delete))